@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+import Helper
+import app
+
+#  CONFIGURATION  #
+Questions_File = "Benchmark_Questions.json"
+
+
+#  OLLAMA STUB  #
+def start_ollama_stub(tokens=64, token_delay=0.01, port=0):
+    class OllamaStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+
+            started = time.perf_counter()
+            for i in range(tokens):
+                time.sleep(token_delay)
+                self.wfile.write((json.dumps({"model": "llama3", "response": f"token{i} ", "done": False}) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            eval_duration = int((time.perf_counter() - started) * 1e9)
+            self.wfile.write((json.dumps({"model": "llama3", "response": "", "done": True, "eval_count": tokens, "eval_duration": eval_duration}) + "\n").encode("utf-8"))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), OllamaStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Helper.Ollama_Url = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    return server
+
+
+#  STAGE TIMING  #
+def disable_answer_cache():
+    # Every question must run the full pipeline.
+    app.Answer_Cache = Helper.AnswerCache(max_items=0)
+
+def percentiles(samples):
+    samples_ms = np.asarray(samples) * 1000
+    return {f"p{p}": round(float(np.percentile(samples_ms, p)), 2) for p in (50, 90, 99)}
+
+def stage_percentiles():
+    observations = Helper.Metrics.snapshot()["observations"]
+    return {
+        name.split(":", 1)[1]: {p: round(observation[p] * 1000, 2) for p in ("p50", "p90", "p99")}
+        for name, observation in observations.items() if name.startswith("stage_seconds:")
+    }
+
+
+#  LATENCY AND THROUGHPUT  #
+async def run_concurrency_level(queries, length_input, concurrency):
+    # Drives the async handler Gradio serves (retrieval executor, Ollama semaphore), with Gradio's
+    # handler slots and queue bound emulated in front of it.
+    client_slots = asyncio.Semaphore(concurrency)
+    handler_slots = asyncio.Semaphore(app.Handler_Concurrency)
+    end_to_end = []
+    first_answer = []
+    waiting = 0
+    rejected = 0
+
+    async def ask(query):
+        nonlocal waiting, rejected
+        async with client_slots:
+            if waiting >= app.Queue_Max_Size:
+                rejected += 1
+                return
+            started = time.perf_counter()
+            waiting += 1
+            async with handler_slots:
+                waiting -= 1
+                first = True
+                async for answer in app.retrieve_text_async(query, length_input):
+                    if first:
+                        first_answer.append(time.perf_counter() - started)
+                        first = False
+            end_to_end.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(ask(query) for query in queries))
+    return end_to_end, first_answer, rejected
+
+async def run_latency_async(questions, length_input, concurrency_levels, repeats=1):
+    Results = []
+    queries = [question["question"] for question in questions] * repeats
+
+    for concurrency in concurrency_levels:
+        Helper.Metrics.reset()
+        started = time.perf_counter()
+        end_to_end, first_answer, rejected = await run_concurrency_level(queries, length_input, concurrency)
+        wall = time.perf_counter() - started
+
+        Results.append({
+            "length_input": length_input,
+            "concurrency": concurrency,
+            "questions": len(queries),
+            "rejected": rejected,
+            "throughput_qps": round(len(end_to_end) / wall, 3),
+            "end_to_end_ms": percentiles(end_to_end),
+            "first_answer_ms": percentiles(first_answer),
+            "stages_ms": stage_percentiles(),
+        })
+        print(json.dumps(Results[-1]))
+
+    return Results
+
+def run_latency(questions, lengths, concurrency_levels, repeats=1):
+    # One event loop for the whole run: the app's asyncio semaphore binds to the loop it first waits on.
+    async def run_all():
+        Results = []
+        for length_input in lengths:
+            Results.extend(await run_latency_async(questions, length_input, concurrency_levels, repeats))
+        return Results
+    return asyncio.run(run_all())
+
+
+#  RETRIEVAL QUALITY  #
+def chunk_configs_on_disk(model_name, type="text"):
+    model_folder = os.path.dirname(Helper.chroma_directory(model_name, type, 0, 0))
+    if not os.path.exists(model_folder):
+        return []
+    configs = [re.match(r"^(\d+)_(\d+)$", folder) for folder in os.listdir(model_folder)]
+    return sorted((int(match.group(1)), int(match.group(2))) for match in configs if match)
+
+def is_relevant(doc, question, level):
+    if doc.metadata.get("chapter") != question["chapter"]:
+        return False
+    if level == "section":
+        return question.get("section") is not None and question["section"] in doc.page_content
+    return True
+
+def run_quality(questions, top_k_per_chapter_values, top_k=10):
+    Results = []
+    for chunk_size, chunk_overlap in chunk_configs_on_disk(app.model_name):
+        for top_k_per_chapter in top_k_per_chapter_values:
+            ranks = {"chapter": [], "section": []}
+            for question in questions:
+                docs = app.retrieve_docs(question["question"], chunk_size, chunk_overlap, top_k_per_chapter, top_k)
+                for level in ranks:
+                    rank = next((i + 1 for i, doc in enumerate(docs) if is_relevant(doc, question, level)), None)
+                    ranks[level].append(rank)
+
+            result = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "top_k_per_chapter": top_k_per_chapter, "top_k": top_k}
+            for level, level_ranks in ranks.items():
+                for k in (1, 3, 5, top_k):
+                    result[f"{level}_recall@{k}"] = round(sum(rank is not None and rank <= k for rank in level_ranks) / len(level_ranks), 3)
+                result[f"{level}_mrr"] = round(sum(1.0 / rank for rank in level_ranks if rank) / len(level_ranks), 3)
+            Results.append(result)
+            print(json.dumps(result))
+
+    return Results
+
+
+#  RUN BENCHMARK  #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and retrieval-quality benchmark for the IRC RAG pipeline.")
+    parser.add_argument("--questions", default=Questions_File)
+    parser.add_argument("--length", default=["Very Short", "Very Long"], nargs="+")
+    parser.add_argument("--concurrency", default=[1, 4, 8], type=int, nargs="+")
+    parser.add_argument("--repeats", default=1, type=int)
+    parser.add_argument("--top-k-per-chapter", default=[2, 3, 4, 5], type=int, nargs="+")
+    parser.add_argument("--stub-tokens", default=64, type=int)
+    parser.add_argument("--stub-token-delay", default=0.01, type=float)
+    parser.add_argument("--skip-latency", action="store_true")
+    parser.add_argument("--skip-quality", action="store_true")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+
+    Report = {"latency": [], "quality": []}
+    if not args.skip_latency:
+        server = start_ollama_stub(args.stub_tokens, args.stub_token_delay)
+        disable_answer_cache()
+        Report["latency"] = run_latency(questions, args.length, args.concurrency, args.repeats)
+        server.shutdown()
+    if not args.skip_quality:
+        Report["quality"] = run_quality(questions, args.top_k_per_chapter)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(Report, f, indent=1)
@@ -6,9 +6,28 @@ import shutil
 from langchain.schema import Document 
 from langchain.vectorstores import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import requests
 import json
+import logging
+import hashlib
+import threading
+import queue
+import time
+import socket
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 #   Preprocessing.py helper functions   #
 def clean_pdf_text(text):
@@ -53,35 +72,150 @@ def extract_text_without_tables(page, table_areas):
     
     return clean_pdf_text(page_text)
 
+# Chapters are written as JSON; a legacy chapter_N.pkl is only read once, to migrate it.
 def save_chapter_to_pkl(chapter, chapter_data, output_folder="Pkl_Files/Chapters"):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
-    chapter_filename = os.path.join(output_folder, f"chapter_{chapter}.pkl")
-    with open(chapter_filename, "wb") as f:
-        pickle.dump(chapter_data, f)
+    chapter_filename = os.path.join(output_folder, f"chapter_{chapter}.json")
+    with open(chapter_filename + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(chapter_data, f, ensure_ascii=False)
+    os.replace(chapter_filename + ".tmp", chapter_filename)
 
 def load_chapter_from_pkl(chapter, input_folder="Pkl_Files/Chapters"):
-    chapter_filename = os.path.join(input_folder, f"chapter_{chapter}.pkl")
+    chapter_filename = os.path.join(input_folder, f"chapter_{chapter}.json")
     if os.path.exists(chapter_filename):
-        with open(chapter_filename, "rb") as f:
-            return pickle.load(f)
-    else:
-        print(f"Chapter {chapter} file not found!")
-        return None
+        with open(chapter_filename, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    legacy_filename = os.path.join(input_folder, f"chapter_{chapter}.pkl")
+    if os.path.exists(legacy_filename):
+        print(f"Migrating {legacy_filename} to JSON.")
+        with open(legacy_filename, "rb") as f:
+            chapter_data = pickle.load(f)
+        save_chapter_to_pkl(chapter, chapter_data, input_folder)
+        return chapter_data
 
-def save_chunks_to_pkl(chunks, chapter, chunk_size, chunk_overlap, type):
+    print(f"Chapter {chapter} file not found!")
+    return None
+
+def chunk_folder_path(chunk_size, chunk_overlap, type):
     if(type=="text"):
         output_folder="Pkl_Files/Text_Chunks"
     else:
         output_folder="Pkl_Files/Table_Chunks"
+    return os.path.join(output_folder, f"{chunk_size}_{chunk_overlap}")
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def chunk_ids(chunks):
+    ids = []
+    seen = {}
+    for doc in chunks:
+        chunk_hash = content_hash(doc.page_content)[:32]
+        seen[chunk_hash] = seen.get(chunk_hash, 0) + 1
+        ids.append(f"{chunk_hash}_{seen[chunk_hash]}")
+    return ids
+
+#   Columnar chunk store   #
+# store.json is replaced last and carries the content digest, so a store is complete once it exists.
+Chunk_Store_Files = ("chunks.bin", "offsets.npy", "chapters.npy", "chunk_indices.npy", "store.json")
 
-    folder_path = os.path.join(output_folder, f"{chunk_size}_{chunk_overlap}")
+def chunk_store_exists(chunk_size, chunk_overlap, type):
+    folder_path = chunk_folder_path(chunk_size, chunk_overlap, type)
+    return all(os.path.exists(os.path.join(folder_path, file)) for file in Chunk_Store_Files)
+
+def chunk_store_digest(chunk_size, chunk_overlap, type):
+    folder_path = chunk_folder_path(chunk_size, chunk_overlap, type)
+    if not chunk_store_exists(chunk_size, chunk_overlap, type):
+        return None
+    return load_manifest(os.path.join(folder_path, "store.json")).get("digest")
+
+# UTF-8 blob + offsets packing shared by the chunk store and the table row index.
+def _pack_texts(texts):
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(text) for text in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _unpack_text(blob, offsets, i):
+    return blob[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+def save_chunk_store(chapter_chunks_list, chunk_size, chunk_overlap, type):
+    folder_path = chunk_folder_path(chunk_size, chunk_overlap, type)
     os.makedirs(folder_path, exist_ok=True)
-    
-    filename = os.path.join(folder_path, f"chapter_{chapter}_chunks.pkl")
-    with open(filename, "wb") as f:
-        pickle.dump(chunks, f)
+
+    docs = [doc for chapter_name, chapter_chunks in chapter_chunks_list for doc in chapter_chunks]
+    blob, offsets = _pack_texts([doc.page_content for doc in docs])
+    chapters = np.asarray([doc.metadata["chapter"] for doc in docs], dtype=np.int32)
+    chunk_indices = np.asarray([doc.metadata["chunk_index"] for doc in docs], dtype=np.int32)
+
+    digest = hashlib.sha256()
+    for array in (blob, offsets, chapters, chunk_indices):
+        digest.update(array.tobytes())
+
+    with open(os.path.join(folder_path, "chunks.bin.tmp"), "wb") as f:
+        blob.tofile(f)
+    for file, array in (("offsets.npy", offsets), ("chapters.npy", chapters), ("chunk_indices.npy", chunk_indices)):
+        with open(os.path.join(folder_path, file + ".tmp"), "wb") as f:
+            np.save(f, array)
+    save_manifest({"digest": digest.hexdigest(), "chunks": len(docs)}, os.path.join(folder_path, "store.json.tmp"))
+    for file in Chunk_Store_Files:
+        os.replace(os.path.join(folder_path, file + ".tmp"), os.path.join(folder_path, file))
+
+    print(f"Saved {len(docs)} chunks to chunk store in {folder_path}.")
+
+class ChunkStore:
+    def __init__(self, chunk_size, chunk_overlap, type):
+        folder_path = chunk_folder_path(chunk_size, chunk_overlap, type)
+        self.digest = load_manifest(os.path.join(folder_path, "store.json")).get("digest")
+        self.offsets = np.load(os.path.join(folder_path, "offsets.npy"), mmap_mode="r")
+        self.chapters = np.load(os.path.join(folder_path, "chapters.npy"), mmap_mode="r")
+        self.chunk_indices = np.load(os.path.join(folder_path, "chunk_indices.npy"), mmap_mode="r")
+
+        blob_path = os.path.join(folder_path, "chunks.bin")
+        if os.path.getsize(blob_path) > 0:
+            self._blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self._blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def get_text(self, chunk_id):
+        return _unpack_text(self._blob, self.offsets, chunk_id)
+
+    def get(self, chunk_id):
+        return Document(
+            page_content=self.get_text(chunk_id),
+            metadata={"chapter": int(self.chapters[chunk_id]), "chunk_index": int(self.chunk_indices[chunk_id])}
+        )
+
+    def chapter_ids(self, chapter):
+        return np.flatnonzero(self.chapters == chapter)
+
+    def chapter_list(self):
+        return sorted(int(chapter) for chapter in np.unique(self.chapters))
+
+    def iter_chapters(self, selected_chapters=None):
+        for chapter in (self.chapter_list() if selected_chapters is None else selected_chapters):
+            yield (f"chapter_{chapter}", [self.get(chunk_id) for chunk_id in self.chapter_ids(chapter)])
+
+    def iter_documents(self, batch_size=256):
+        for start in range(0, len(self), batch_size):
+            yield [self.get(chunk_id) for chunk_id in range(start, min(start + batch_size, len(self)))]
 
 def convert_to_text(chapter_number, tables_list):
     text_output = []
@@ -101,8 +235,56 @@ def convert_to_text(chapter_number, tables_list):
 
 
 
+Crop_Rect = (20, 50, 600, 750)
+
+def process_pages(pdf_path, page_numbers, crop_rect=Crop_Rect):
+    pages = []
+    with pymupdf.open(pdf_path) as doc:
+        for page_num in page_numbers:
+            page = doc[page_num]
+            if crop_rect is not None:
+                page.set_cropbox(pymupdf.Rect(*crop_rect))
+
+            page_tables, table_areas = extract_tables(page)
+            cleaned_text = extract_text_without_tables(page, table_areas)
+            pages.append((page_num, cleaned_text, page_tables))
+    return pages
+
+
+
+
 #   Preprocessing.py Parent functions   #
-def ProcessText(pdf_path, chapters):
+def ProcessText_Parallel(pdf_path, chapters, max_workers=None, pages_per_task=16, crop_rect=Crop_Rect):
+    page_numbers = sorted({page_num for start, end in chapters.values() for page_num in range(start - 1, end)})
+    page_batches = [page_numbers[i:i + pages_per_task] for i in range(0, len(page_numbers), pages_per_task)]
+
+    Pages = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for pages in executor.map(process_pages, repeat(pdf_path), page_batches, repeat(crop_rect)):
+            for page_num, cleaned_text, page_tables in pages:
+                Pages[page_num] = (cleaned_text, page_tables)
+    print(f"Extracted {len(Pages)} pages from {pdf_path}.")
+
+    for chapter, (start, end) in chapters.items():
+        text = ""
+        tables = []
+
+        for page_num in range(start - 1, end):
+            cleaned_text, page_tables = Pages[page_num]
+            text += cleaned_text + " "
+            tables.extend(page_tables)
+
+        chapter_data = {
+            "text": text.strip(),
+            "tables": tables
+        }
+
+        save_chapter_to_pkl(chapter, chapter_data)
+
+def ProcessText(pdf_path, chapters, parallel=False, max_workers=None):
+    if parallel:
+        return ProcessText_Parallel(pdf_path, chapters, max_workers=max_workers)
+
     doc = pymupdf.open(pdf_path)
     for page in doc:
         page.set_cropbox(pymupdf.Rect(20, 50, 600, 750))
@@ -130,7 +312,12 @@ def ProcessText(pdf_path, chapters):
 
             save_chapter_to_pkl(chapter, chapter_data)
 
-def chunk_chapters(chapters_to_chunk, type, chunk_size=1000, chunk_overlap=100):
+def chunk_chapters(chapters_to_chunk, type, chunk_size=1000, chunk_overlap=100, incremental=False):
+    manifest_path = os.path.join(chunk_folder_path(chunk_size, chunk_overlap, type), "manifest.json")
+    manifest = load_manifest(manifest_path)
+    Store_Chapters = {extract_chapter_number(chapter_name): chapter_chunks for chapter_name, chapter_chunks in retrieve_chunks(chunk_size, chunk_overlap, type)}
+    rechunked = False
+
     for chapter in chapters_to_chunk:
         chapter_data = load_chapter_from_pkl(chapter)
         if chapter_data is None:
@@ -140,6 +327,11 @@ def chunk_chapters(chapters_to_chunk, type, chunk_size=1000, chunk_overlap=100):
         else:
             DATA = convert_to_text(chapter,chapter_data["tables"])
 
+        DATA_hash = content_hash(DATA)
+        if incremental and manifest.get(str(chapter)) == DATA_hash and chapter in Store_Chapters:
+            print(f"Chapter {chapter} unchanged, skipping chunking.")
+            continue
+
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
         chunks = text_splitter.split_text(DATA)
 
@@ -148,54 +340,140 @@ def chunk_chapters(chapters_to_chunk, type, chunk_size=1000, chunk_overlap=100):
             for idx, chunk in enumerate(chunks)
         ]
         
-        save_chunks_to_pkl(chapter_chunks, chapter, chunk_size, chunk_overlap,type)
+        Store_Chapters[chapter] = chapter_chunks
+        manifest[str(chapter)] = DATA_hash
+        rechunked = True
+
+    if rechunked or not chunk_store_exists(chunk_size, chunk_overlap, type):
+        save_chunk_store([(f"chapter_{chapter}", Store_Chapters[chapter]) for chapter in sorted(Store_Chapters)], chunk_size, chunk_overlap, type)
+    save_manifest(manifest, manifest_path)
 
 
 
 
 #   SaveModels.py Parent function   #
-def Save_ChromaDb(Chunks,type,Model,model_name,chunk_size,chunk_overlap):
+def Save_ChromaDb(Chunks,type,Model,model_name,chunk_size,chunk_overlap,incremental=False,build_lexical=True,build_table_rows=True):
     ChromaDb_Langchain=[]
-    if(type=="text"):
-        Chroma_Loc="ChromaDB_Text"
-    else:
-        Chroma_Loc="ChromaDB_Tables"
+    clear_chroma_pool()
+    manifest_path = f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/manifest.json"
+    manifest = load_manifest(manifest_path)
+    changed = False
 
     for chapter_chunks in Chunks:
         chapter_number = chapter_chunks[0]
-        persist_dir = f"./{Chroma_Loc}/{model_name.replace('/', '-')}/{chunk_size}_{chunk_overlap}/{chapter_number}"
+        persist_dir = f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/{chapter_number}"
+        ids = chunk_ids(chapter_chunks[1])
+        chapter_hash = content_hash(model_name + "".join(ids))
+
+        if incremental and os.path.exists(persist_dir):
+            if manifest.get(chapter_number) == chapter_hash:
+                print(f"Chapter {chapter_number} unchanged, skipping.")
+                continue
+            print(f"Updating chapter: {chapter_number}")
+            ChromaDb_Langchain.append(update_chroma_chapter(persist_dir, chapter_chunks[1], ids, Model))
+            manifest[chapter_number] = chapter_hash
+            changed = True
+            continue
 
         if os.path.exists(persist_dir):
             shutil.rmtree(persist_dir)
+        changed = changed or manifest.get(chapter_number) != chapter_hash
 
         print(f"Processing chapter: {chapter_number}")
 
         if not chapter_chunks[1] or all(not doc.page_content.strip() for doc in chapter_chunks[1]):
             print(f"Skipping chapter {chapter_number}: No valid content.")
+            manifest.pop(chapter_number, None)
             continue
         
         ChromaDb_Langchain.append(
             Chroma.from_documents(
                 documents=chapter_chunks[1],
                 embedding=Model,
+                ids=ids,
                 persist_directory=persist_dir,
                 collection_metadata={"hnsw:space": "cosine"}
             )
         )
+        manifest[chapter_number] = chapter_hash
+
+    # The unified index was built from the old chapters; drop it so the app falls back to the
+    # per-chapter stores until Save_Unified_ChromaDb is run again.
+    unified_dir = f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/{Unified_Index_Name}"
+    if changed and os.path.exists(unified_dir):
+        shutil.rmtree(unified_dir)
+        manifest.pop(Unified_Index_Name, None)
+        print(f"Removed stale unified index: {unified_dir}")
 
+    save_manifest(manifest, manifest_path)
+    if build_lexical:
+        # Always over the full chunk config, not just the chapters passed in.
+        build_lexical_index(chunk_size, chunk_overlap, type)
+    if build_table_rows and type == "table":
+        # The row-level table index the app serves is built alongside the table stores, over every chapter.
+        save_table_row_index(None, Model, model_name)
     print(" Vector databases created.")
     return ChromaDb_Langchain
 
-def retrieve_chunks(chunk_size, chunk_overlap,type ):
-    if(type=="text"):
-        input_folder="Pkl_Files/Text_Chunks"
-    else:
-        input_folder="Pkl_Files/Table_Chunks"
+def update_chroma_chapter(persist_dir, chunks, ids, Model):
+    Chapter_DB = Chroma(persist_directory=persist_dir, embedding_function=Model, collection_metadata={"hnsw:space": "cosine"})
+    existing_ids = set(Chapter_DB._collection.get(include=[])["ids"])
+    new_ids = set(ids)
 
-    chunk_folder = os.path.join(input_folder, f"{chunk_size}_{chunk_overlap}")
-    
+    stale_ids = list(existing_ids - new_ids)
+    if stale_ids:
+        Chapter_DB._collection.delete(ids=stale_ids)
+
+    added = [(doc, chunk_id) for doc, chunk_id in zip(chunks, ids) if chunk_id not in existing_ids]
+    if added:
+        Chapter_DB.add_documents([doc for doc, chunk_id in added], ids=[chunk_id for doc, chunk_id in added])
+
+    kept = [(doc, chunk_id) for doc, chunk_id in zip(chunks, ids) if chunk_id in existing_ids]
+    if kept:
+        Chapter_DB._collection.update(ids=[chunk_id for doc, chunk_id in kept], metadatas=[doc.metadata for doc, chunk_id in kept])
+
+    print(f"Added {len(added)}, removed {len(stale_ids)}, kept {len(kept)} chunks in {persist_dir}")
+    return Chapter_DB
+
+def Save_Unified_ChromaDb(Chunks,type,Model,model_name,chunk_size,chunk_overlap):
+    clear_chroma_pool()
+    persist_dir = f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/{Unified_Index_Name}"
+    if os.path.exists(persist_dir):
+        shutil.rmtree(persist_dir)
+
+    documents = []
+    ids = []
+    chapter_count = 0
+    for chapter_number, chapter_chunks in Chunks:
+        chapter_count += 1
+        # Same content-hash ids as the per-chapter stores, prefixed so identical text in two chapters stays distinct.
+        for doc, chunk_id in zip(chapter_chunks, chunk_ids(chapter_chunks)):
+            if doc.page_content.strip():
+                documents.append(doc)
+                ids.append(f"{chapter_number}_{chunk_id}")
+    if not documents:
+        print("Skipping unified index: No valid content.")
+        return None
+
+    print(f"Processing unified index: {len(documents)} chunks from {chapter_count} chapters")
+    ChromaDb_Langchain = Chroma.from_documents(
+        documents=documents,
+        embedding=Model,
+        ids=ids,
+        persist_directory=persist_dir,
+        collection_metadata={"hnsw:space": "cosine"}
+    )
+    manifest_path = f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/manifest.json"
+    manifest = load_manifest(manifest_path)
+    manifest[Unified_Index_Name] = content_hash(model_name + "".join(ids))
+    save_manifest(manifest, manifest_path)
+    print(" Unified vector database created.")
+    return ChromaDb_Langchain
+
+def load_legacy_chunk_pickles(chunk_size, chunk_overlap, type):
+    # Only read by convert_chunks_to_store, to migrate chunk folders written before the chunk store.
+    chunk_folder = chunk_folder_path(chunk_size, chunk_overlap, type)
     if not os.path.exists(chunk_folder):
-        print(f"No chunks found for size {chunk_size} and overlap {chunk_overlap} in {chunk_folder}.")
         return []
 
     chunk_files = [f for f in os.listdir(chunk_folder) if f.endswith(".pkl")]
@@ -215,8 +493,37 @@ def retrieve_chunks(chunk_size, chunk_overlap,type ):
                 chapter_chunks_list.append((f"chapter_{chapter_name}", chunk_data))
             else:
                 print(f"Invalid data format in file: {chunk_file}")
+    return chapter_chunks_list
+
+def convert_chunks_to_store(chunk_size, chunk_overlap, type):
+    chapter_chunks_list = load_legacy_chunk_pickles(chunk_size, chunk_overlap, type)
+    if chapter_chunks_list:
+        print(f"Migrating {len(chapter_chunks_list)} chunk pickles to the chunk store.")
+        save_chunk_store(chapter_chunks_list, chunk_size, chunk_overlap, type)
+
+def open_chunk_store(chunk_size, chunk_overlap, type):
+    # The store is the only chunk format; legacy pickles are migrated the first time a config is opened.
+    if not chunk_store_exists(chunk_size, chunk_overlap, type):
+        convert_chunks_to_store(chunk_size, chunk_overlap, type)
+    if not chunk_store_exists(chunk_size, chunk_overlap, type):
+        return None
+    return ChunkStore(chunk_size, chunk_overlap, type)
+
+def stream_chunks(chunk_size, chunk_overlap, type, selected_chapters=None):
+    Store = open_chunk_store(chunk_size, chunk_overlap, type)
+    if Store is None:
+        return iter(())
+    return Store.iter_chapters(selected_chapters)
+
+def retrieve_chunks(chunk_size, chunk_overlap,type):
+    chunk_folder = chunk_folder_path(chunk_size, chunk_overlap, type)
+    Store = open_chunk_store(chunk_size, chunk_overlap, type)
+    if Store is None:
+        print(f"No chunks found for size {chunk_size} and overlap {chunk_overlap} in {chunk_folder}.")
+        return []
 
-    print(f"Retrieved chunks for {len(chapter_chunks_list)} chapters from {chunk_folder}.")
+    chapter_chunks_list = list(Store.iter_chapters())
+    print(f"Retrieved chunks for {len(chapter_chunks_list)} chapters from chunk store in {chunk_folder}.")
     return chapter_chunks_list
 
 def retrieve_relevant_chunks_Pass_Chapters_To_BestChunks(persist_dir,Chunks,Model,query,top_k):
@@ -240,71 +547,1271 @@ def extract_chapter_number(chapter_name):
     except (IndexError, ValueError):
         return -1
 
-#   RunModels.py parent functions   #
-def load_chroma_databases(model_name,type, chunk_size=1000, chunk_overlap=100, selected_chapters=None):
-    ChromaDB_Chapters = {}
-    ModelFileName = model_name.replace('/', '-')
+#   Tracing and metrics   #
+Metrics_Logger = logging.getLogger("irc_rag.metrics")
+
+class PipelineMetrics:
+    def __init__(self, max_samples=1024):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._observations = {}
+        self._sources = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._observations:
+                self._observations[name] = {"count": 0, "sum": 0.0, "max": 0.0, "samples": deque(maxlen=self.max_samples)}
+            observation = self._observations[name]
+            observation["count"] += 1
+            observation["sum"] += value
+            observation["max"] = max(observation["max"], value)
+            observation["samples"].append(value)
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(f"stage_seconds:{stage}", elapsed)
+            if Metrics_Logger.isEnabledFor(logging.DEBUG):
+                Metrics_Logger.debug(json.dumps({"span": stage, "ms": round(elapsed * 1000, 3), "thread": threading.current_thread().name}))
+
+    def register_source(self, name, stats_function):
+        with self._lock:
+            self._sources[name] = stats_function
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            observations = {name: (observation["count"], observation["sum"], observation["max"], list(observation["samples"])) for name, observation in self._observations.items()}
+            sources = dict(self._sources)
+
+        snapshot = {"counters": counters, "observations": {}, "sources": {}}
+        for name, (count, total, maximum, samples) in observations.items():
+            snapshot["observations"][name] = {
+                "count": count,
+                "sum": total,
+                "max": maximum,
+                "p50": float(np.percentile(samples, 50)),
+                "p90": float(np.percentile(samples, 90)),
+                "p99": float(np.percentile(samples, 99)),
+            }
+        for name, stats_function in sources.items():
+            snapshot["sources"][name] = stats_function()
+        return snapshot
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"irc_rag_{name}_total {value}")
+        for name, observation in sorted(snapshot["observations"].items()):
+            metric, _, label = name.partition(":")
+            labels = f'stage="{label}"' if label else ""
+            for quantile, value in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+                quantile_labels = f'{labels},quantile="{quantile}"' if labels else f'quantile="{quantile}"'
+                lines.append(f"irc_rag_{metric}{{{quantile_labels}}} {observation[value]}")
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"irc_rag_{metric}_sum{suffix} {observation['sum']}")
+            lines.append(f"irc_rag_{metric}_count{suffix} {observation['count']}")
+        for source, stats in sorted(snapshot["sources"].items()):
+            for key, value in sorted(stats.items()):
+                lines.append(f"irc_rag_{source}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+Metrics = PipelineMetrics()
+
+def traced(stage):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with Metrics.span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_metrics_server(port=9464, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(Metrics.snapshot()).encode("utf-8"), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = Metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics_server").start()
+    print(f"Serving pipeline metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def start_metrics_logger(interval=60):
+    def log_metrics():
+        while True:
+            time.sleep(interval)
+            Metrics_Logger.info(json.dumps(Metrics.snapshot()))
+
+    threading.Thread(target=log_metrics, daemon=True, name="metrics_logger").start()
+
+
+#   Embedding cache   #
+def normalize_embedding_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+@contextmanager
+def _file_lock(path):
+    # Exclusive lock across processes sharing the same cache folder.
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class EmbeddingCacheStore:
+    # One store per cache folder, shared by every CachedEmbeddings wrapper pointing at it.
+    def __init__(self, folder, max_memory_items=20000):
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self._memory = OrderedDict()
+
+        os.makedirs(folder, exist_ok=True)
+        self._vectors_path = os.path.join(folder, "vectors.f32")
+        self._index_path = os.path.join(folder, "index.txt")
+        self._lock_path = os.path.join(folder, "index.lock")
+        self._dim = None
+        self._vectors = None
+        self.rows = {}
+
+        with _file_lock(self._lock_path):
+            self._load_index()
+
+    def _load_index(self):
+        # Each index line carries its own row number ("row\tkey"); lines pointing past the end of
+        # the vectors file (a write that never completed) are dropped.
+        if not (os.path.exists(self._index_path) and os.path.exists(self._vectors_path)):
+            return
+        with open(self._index_path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        if not lines[0]:
+            return
+        self._dim = int(lines[0])
+        row_count = os.path.getsize(self._vectors_path) // (4 * self._dim)
+        for line in lines[1:]:
+            row, _, key = line.partition("\t")
+            if key and row.isdigit() and int(row) < row_count:
+                self.rows[key] = int(row)
+
+    def _read_row(self, row):
+        if self._vectors is None or row >= len(self._vectors):
+            row_count = os.path.getsize(self._vectors_path) // (4 * self._dim)
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(row_count, self._dim))
+        return np.array(self._vectors[row])
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def lookup(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        if key in self.rows:
+            vector = self._read_row(self.rows[key])
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+        return None
+
+    def remember(self, keys, vectors):
+        for key, vector in zip(keys, vectors):
+            self._remember(key, np.asarray(vector, dtype=np.float32))
+
+    def store(self, keys, vectors):
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with _file_lock(self._lock_path):
+            if not os.path.exists(self._index_path) or os.path.getsize(self._index_path) == 0:
+                self._dim = vectors.shape[1]
+                with open(self._index_path, "w", encoding="utf-8") as f:
+                    f.write(f"{self._dim}\n")
+                with open(self._vectors_path, "wb"):
+                    pass
+            elif self._dim is None:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    self._dim = int(f.readline())
+
+            # Row numbers come from the vectors file itself, under the lock, and a torn tail left by
+            # an interrupted writer is cut back to a whole row before appending.
+            row_bytes = 4 * self._dim
+            size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+            first_row = size // row_bytes
+            with open(self._vectors_path, "ab") as f:
+                if size % row_bytes:
+                    f.truncate(first_row * row_bytes)
+                f.write(vectors.tobytes())
+            with open(self._index_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{row}\t{key}\n" for row, key in enumerate(keys, start=first_row)))
+
+        for row, (key, vector) in enumerate(zip(keys, vectors), start=first_row):
+            self.rows[key] = row
+            self._remember(key, vector)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "memory_items": len(self._memory), "disk_items": len(self.rows)}
+
+_Embedding_Cache_Stores = {}
+_Embedding_Cache_Stores_Lock = threading.Lock()
+
+def get_embedding_cache_store(folder, max_memory_items=20000):
+    folder = os.path.abspath(folder)
+    with _Embedding_Cache_Stores_Lock:
+        if folder not in _Embedding_Cache_Stores:
+            _Embedding_Cache_Stores[folder] = EmbeddingCacheStore(folder, max_memory_items)
+        return _Embedding_Cache_Stores[folder]
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, Model, model_name, cache_folder="Embedding_Cache", max_memory_items=20000, persist_queries=False):
+        self.Model = Model
+        self.model_name = model_name
+        # Query vectors stay in the memory LRU unless asked: persisting them would grow the cache with
+        # user traffic and put a locked disk write on every question.
+        self.persist_queries = persist_queries
+        self.store = get_embedding_cache_store(os.path.join(cache_folder, model_name.replace('/', '-')), max_memory_items)
+
+    def _key(self, kind, text):
+        return f"{kind}:{content_hash(normalize_embedding_text(text))[:40]}"
+
+    def _embed(self, kind, texts, embed_missing, persist=True):
+        store = self.store
+        with store.lock:
+            keys = [self._key(kind, text) for text in texts]
+            vectors = [store.lookup(key) for key in keys]
+            missing = {}
+            for i, (key, vector) in enumerate(zip(keys, vectors)):
+                if vector is None:
+                    missing.setdefault(key, []).append(i)
+            store.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            new_vectors = embed_missing([texts[missing[key][0]] for key in missing_keys])
+            with store.lock:
+                if persist:
+                    store.store([key for key in missing_keys if key not in store.rows], [vector for key, vector in zip(missing_keys, new_vectors) if key not in store.rows])
+                else:
+                    store.remember(missing_keys, new_vectors)
+            for key, vector in zip(missing_keys, new_vectors):
+                for i in missing[key]:
+                    vectors[i] = np.asarray(vector, dtype=np.float32)
+
+        return [vector.tolist() for vector in vectors]
+
+    def embed_documents(self, texts):
+        return self._embed("doc", list(texts), self.Model.embed_documents)
+
+    def embed_query(self, text):
+        return self._embed("query", [text], lambda texts: [self.Model.embed_query(texts[0])], self.persist_queries)[0]
+
+    def stats(self):
+        return self.store.stats()
+
+
+#   Embedding backends   #
+Onnx_Int8_File = "onnx/model_quint8_avx2.onnx"
+
+def create_embedding_model(model_name, backend="torch", batch_size=32, threads=None, onnx_file=None, device=None):
+    model_kwargs = {"device": device} if device else {}
+    if backend == "onnx" or backend == "onnx-int8":
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx embedding backend requires onnxruntime and optimum: pip install optimum[onnxruntime]")
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+        onnx_kwargs = {"provider": "CPUExecutionProvider", "session_options": session_options}
+        if onnx_file or backend == "onnx-int8":
+            onnx_kwargs["file_name"] = onnx_file or Onnx_Int8_File
+        model_kwargs.update({"backend": "onnx", "model_kwargs": onnx_kwargs})
+    elif backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    print(f"Loading embedding model: {model_name} ({backend}, batch_size={batch_size}, threads={threads})")
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs={"batch_size": batch_size})
+
+class QueryMicroBatcher(Embeddings):
+    def __init__(self, Model, window=0.005, max_batch=32):
+        self.Model = Model
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True, name="query_micro_batcher").start()
+
+    def embed_documents(self, texts):
+        return self.Model.embed_documents(texts)
+
+    def embed_query(self, text):
+        request = {"text": text, "done": threading.Event(), "vector": None, "error": None}
+        self._queue.put(request)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["vector"]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                # Symmetric sentence-transformers models encode queries and documents the same way.
+                if len(batch) == 1:
+                    vectors = [self.Model.embed_query(batch[0]["text"])]
+                else:
+                    vectors = self.Model.embed_documents([request["text"] for request in batch])
+                Metrics.observe("query_batch_size", len(batch))
+                for request, vector in zip(batch, vectors):
+                    request["vector"] = vector
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+def embedding_validation_texts(max_chunks=32):
+    # The chapter intros plus an even spread of chunks from the first text chunk store on disk.
+    texts = [doc.page_content for doc in Chapters_Intros]
+    text_root = os.path.dirname(chunk_folder_path(0, 0, "text"))
+    configs = [re.match(r"^(\d+)_(\d+)$", folder) for folder in sorted(os.listdir(text_root))] if os.path.exists(text_root) else []
+    for match in configs:
+        if match and chunk_store_exists(int(match.group(1)), int(match.group(2)), "text"):
+            Store = ChunkStore(int(match.group(1)), int(match.group(2)), "text")
+            chunk_texts = [Store.get_text(i) for i in np.linspace(0, len(Store) - 1, min(max_chunks, len(Store))).astype(int)] if len(Store) else []
+            texts.extend(text for text in chunk_texts if text.strip())
+            break
+    return texts
+
+def validate_embedding_backend(Reference_Model, Candidate_Model, texts, min_cosine=0.99, min_overlap=0.8):
+    reference = _normalize_rows(np.asarray(Reference_Model.embed_documents(texts), dtype=np.float32))
+    candidate = _normalize_rows(np.asarray(Candidate_Model.embed_documents(texts), dtype=np.float32))
+    cosines = np.sum(reference * candidate, axis=1)
+
+    # Neighbours exclude the text itself, which would otherwise always agree.
+    top_k = min(5, len(texts) - 1)
+    reference_similarity = reference @ reference.T
+    candidate_similarity = candidate @ reference.T
+    np.fill_diagonal(reference_similarity, -np.inf)
+    np.fill_diagonal(candidate_similarity, -np.inf)
+    reference_ranks = np.argsort(-reference_similarity, axis=1)[:, :top_k]
+    candidate_ranks = np.argsort(-candidate_similarity, axis=1)[:, :top_k]
+    overlap = np.mean([len(set(r) & set(c)) / top_k for r, c in zip(reference_ranks, candidate_ranks)]) if top_k > 0 else 1.0
+
+    report = {
+        "texts": len(texts),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        f"top{top_k}_overlap": float(overlap),
+        "passed": bool(cosines.min() >= min_cosine and overlap >= min_overlap),
+    }
+    print(f"Embedding backend validation: {report}")
+    return report
+
+
+#   Embedding model and vector store pool   #
+_Pool_Lock = threading.RLock()
+_Embedding_Models = {}
+_Chroma_Stores = OrderedDict()
+_Chroma_Pool_Size = None
+
+_Embedding_Backend_Fallbacks = set()
+
+Embedding_Config = {"backend": "torch", "batch_size": 32, "threads": None, "micro_batch": False, "device": None}
+
+def configure_embedding_backend(**config):
+    with _Pool_Lock:
+        Embedding_Config.update(config)
+
+def get_embedding_model(model_name, cached=True, backend=None, batch_size=None, threads=None, micro_batch=None, device=None):
+    backend = backend or Embedding_Config["backend"]
+    batch_size = batch_size or Embedding_Config["batch_size"]
+    threads = threads or Embedding_Config["threads"]
+    device = device or Embedding_Config["device"]
+    micro_batch = Embedding_Config["micro_batch"] if micro_batch is None else micro_batch
+    if (model_name, backend) in _Embedding_Backend_Fallbacks:
+        backend = "torch"
+    model_key = (model_name, backend, batch_size, threads, device)
+    with _Pool_Lock:
+        if model_key not in _Embedding_Models:
+            Model = create_embedding_model(model_name, backend, batch_size, threads, device=device)
+            if backend != "torch":
+                # The Chroma stores were built with torch; a backend whose vectors disagree would query them badly.
+                Reference_Model = get_embedding_model(model_name, cached=False, backend="torch", batch_size=batch_size, threads=threads, micro_batch=False, device=device)
+                if not validate_embedding_backend(Reference_Model, Model, embedding_validation_texts())["passed"]:
+                    print(f"Embedding backend {backend} disagrees with torch for {model_name}, falling back to torch.")
+                    Metrics.incr("embedding_backend_fallbacks")
+                    _Embedding_Backend_Fallbacks.add((model_name, backend))
+                    if Embedding_Config["backend"] == backend:
+                        Embedding_Config["backend"] = "torch"
+                    return get_embedding_model(model_name, cached, "torch", batch_size, threads, micro_batch, device)
+            _Embedding_Models[model_key] = Model
+        Model = _Embedding_Models[model_key]
+        if micro_batch:
+            if model_key + ("micro_batch",) not in _Embedding_Models:
+                _Embedding_Models[model_key + ("micro_batch",)] = QueryMicroBatcher(Model)
+            Model = _Embedding_Models[model_key + ("micro_batch",)]
+        if not cached:
+            return Model
+        cache_key = model_key + (micro_batch, "cached")
+        if cache_key not in _Embedding_Models:
+            # Wrappers over the same backend share one cache folder, and with it one EmbeddingCacheStore.
+            cache_name = model_name if backend == "torch" else f"{model_name}@{backend}"
+            _Embedding_Models[cache_key] = CachedEmbeddings(Model, cache_name)
+        return _Embedding_Models[cache_key]
+
+def set_chroma_pool_size(max_stores=None):
+    global _Chroma_Pool_Size
+    with _Pool_Lock:
+        _Chroma_Pool_Size = max_stores
+        _evict_chroma_stores()
+
+def _release_chroma_store(store):
+    # chromadb keeps one System per persist path in a class-level cache, so dropping the LangChain
+    # wrapper alone leaves the index in memory; stop the System and forget it.
+    client = getattr(store, "_client", None)
+    system = getattr(client, "_system", None)
+    if system is None:
+        return
+    try:
+        system.stop()
+    except Exception as e:
+        print(f"Failed to stop vector database client: {e}")
+    systems = getattr(client.__class__, "_identifer_to_system", None)
+    if systems is not None:
+        systems.pop(getattr(client, "_identifier", None), None)
+
+def _evict_chroma_stores():
+    while _Chroma_Pool_Size is not None and len(_Chroma_Stores) > _Chroma_Pool_Size:
+        key, (manifest_mtime, store) = _Chroma_Stores.popitem(last=False)
+        _release_chroma_store(store)
+        print(f"Evicting vector database from pool: {key}")
+
+def chroma_directory(model_name, type, chunk_size, chunk_overlap):
     if(type=="text"):
-        directory_path = f'./ChromaDb_Text/{ModelFileName}/{chunk_size}_{chunk_overlap}'
+        Chroma_Loc="ChromaDB_Text"
     else:
-        directory_path = f'./ChromaDb_Tables/{ModelFileName}/{chunk_size}_{chunk_overlap}'
+        Chroma_Loc="ChromaDB_Tables"
+    return f"./{Chroma_Loc}/{model_name.replace('/', '-')}/{chunk_size}_{chunk_overlap}"
 
-    Model = HuggingFaceEmbeddings(model_name=model_name) 
+Unified_Index_Name = "unified"
 
-    files = os.listdir(directory_path)
-    files_sorted = sorted(files, key=extract_chapter_number)
+def get_chroma_store(model_name, type, chunk_size, chunk_overlap, chapter):
+    key = (model_name, type, chunk_size, chunk_overlap, chapter)
+    # Reopen when the config's manifest changed, e.g. after the stores were rebuilt in another process.
+    manifest_path = os.path.join(chroma_directory(model_name, type, chunk_size, chunk_overlap), "manifest.json")
+    manifest_mtime = os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+    with _Pool_Lock:
+        if key in _Chroma_Stores:
+            if _Chroma_Stores[key][0] == manifest_mtime:
+                _Chroma_Stores.move_to_end(key)
+                return _Chroma_Stores[key][1]
+            print(f"Vector database changed on disk, reopening: {key}")
+            _release_chroma_store(_Chroma_Stores.pop(key)[1])
 
-    for file in files_sorted:
-        chapter_num = extract_chapter_number(file)
-        file_path = os.path.join(directory_path, file)
-        if os.path.exists(file_path) and (selected_chapters is None or chapter_num in selected_chapters):
-            print(f"Loading vector database from: {file_path}")
-            ChromaDB_Chapters[chapter_num] = Chroma(persist_directory=file_path, embedding_function=Model)
-        else:
-            print(f"Vector database doesn't exist or not selected: {file_path}")
+        store_name = Unified_Index_Name if chapter == Unified_Index_Name else f"chapter_{chapter}"
+        file_path = os.path.join(chroma_directory(model_name, type, chunk_size, chunk_overlap), store_name)
+        if not os.path.exists(file_path):
+            print(f"Vector database doesn't exist: {file_path}")
+            return None
+
+        print(f"Loading vector database from: {file_path}")
+        store = Chroma(persist_directory=file_path, embedding_function=get_embedding_model(model_name))
+        _Chroma_Stores[key] = (manifest_mtime, store)
+        _evict_chroma_stores()
+        return store
+
+def list_chroma_chapters(model_name, type, chunk_size, chunk_overlap):
+    directory_path = chroma_directory(model_name, type, chunk_size, chunk_overlap)
+    if not os.path.exists(directory_path):
+        return []
+    chapters = [extract_chapter_number(file) for file in os.listdir(directory_path)]
+    return sorted(chapter for chapter in chapters if chapter != -1)
+
+def warm_chroma_pool(model_name, type, chunk_size, chunk_overlap, chapters=None):
+    get_embedding_model(model_name)
+    if chapters is None:
+        chapters = list_chroma_chapters(model_name, type, chunk_size, chunk_overlap)
+    for chapter in chapters:
+        get_chroma_store(model_name, type, chunk_size, chunk_overlap, chapter)
+
+_Index_Generation = 0
+
+def clear_chroma_pool():
+    global _Index_Generation
+    with _Pool_Lock:
+        for manifest_mtime, store in _Chroma_Stores.values():
+            _release_chroma_store(store)
+        _Chroma_Stores.clear()
+        _Index_Generation += 1
+
+def index_version(model_name, type, chunk_size, chunk_overlap):
+    # Every index that feeds an answer: the vector stores, the lexical index and the table row index.
+    paths = [f"{chroma_directory(model_name, type, chunk_size, chunk_overlap)}/manifest.json", lexical_index_path(chunk_size, chunk_overlap, type), table_row_manifest_path()]
+    mtimes = [os.stat(path).st_mtime_ns if os.path.exists(path) else 0 for path in paths]
+    return f"{_Index_Generation}:" + ":".join(str(mtime) for mtime in mtimes)
+
+
+#   Answer cache   #
+class AnswerCache:
+    def __init__(self, threshold=0.95, ttl=3600, max_items=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._exact = {}
+        self._matrices = {}
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry["time"] > self.ttl]
+        for key in expired:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._exact.pop((entry["scope"], entry["text"]), None)
+        self._matrices.pop(entry["scope"], None)
+
+    def _matrix(self, scope):
+        if scope not in self._matrices:
+            keys = [key for key, entry in self._entries.items() if entry["scope"] == scope]
+            embeddings = np.stack([self._entries[key]["embedding"] for key in keys]) if keys else None
+            self._matrices[scope] = (keys, embeddings)
+        return self._matrices[scope]
+
+    def get(self, query, query_embedding, length_input, version):
+        scope = (length_input, version)
+        text = normalize_embedding_text(query).lower()
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+
+            key = self._exact.get((scope, text))
+            if key is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._entries[key]["answer"]
+
+            keys, embeddings = self._matrix(scope)
+            if query_embedding is not None and embeddings is not None:
+                scores = embeddings @ _normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.semantic_hits += 1
+                    return self._entries[keys[best]]["answer"]
 
-    return [ChromaDB_Chapters[chapter] for chapter in selected_chapters if chapter in ChromaDB_Chapters]
+            self.misses += 1
+            return None
+
+    def put(self, query, query_embedding, length_input, version, answer):
+        scope = (length_input, version)
+        text = normalize_embedding_text(query).lower()
+        with self._lock:
+            if (scope, text) in self._exact:
+                self._remove(self._exact[(scope, text)])
+
+            key = content_hash(f"{scope}|{text}")
+            self._entries[key] = {
+                "scope": scope,
+                "text": text,
+                "embedding": _normalize_rows(np.asarray(query_embedding, dtype=np.float32)),
+                "answer": answer,
+                "time": time.time(),
+            }
+            self._exact[(scope, text)] = key
+            self._matrices.pop(scope, None)
+
+            while len(self._entries) > self.max_items:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._exact.clear()
+            self._matrices.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"exact_hits": self.exact_hits, "semantic_hits": self.semantic_hits, "misses": self.misses, "items": len(self._entries)}
+
+
+#   RunModels.py parent functions   #
+@traced("chapter_db_load")
+def load_chroma_databases(model_name,type, chunk_size=1000, chunk_overlap=100, selected_chapters=None):
+    if selected_chapters is None:
+        selected_chapters = list_chroma_chapters(model_name, type, chunk_size, chunk_overlap)
+
+    ChromaDB_Chapters = []
+    for chapter in selected_chapters:
+        Chapter_DB = get_chroma_store(model_name, type, chunk_size, chunk_overlap, chapter)
+        if Chapter_DB is not None:
+            ChromaDB_Chapters.append(Chapter_DB)
+
+    return ChromaDB_Chapters
 
 def retrieve_relevant_chunks(query, SelectedChapters, top_k_per_chapter):
-    all_results = []
-    for Chapter_DB in SelectedChapters:
-        retriever = Chapter_DB.as_retriever(search_kwargs={"k": top_k_per_chapter})
-        results = retriever.invoke(query)  
-        all_results.extend(results)  
-    return all_results
+    if not SelectedChapters:
+        return []
+    Docs_Scores = search_chapters(query, SelectedChapters, top_k_per_chapter, SelectedChapters[0].embeddings)
+    return [doc for doc, score in Docs_Scores]
+
+_Search_Executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chapter_search")
+
+@traced("chapter_search")
+def search_chapters(query, SelectedChapters, top_k_per_chapter, Model, top_k=None, query_embedding=None, return_embeddings=False):
+    if query_embedding is None:
+        query_embedding = Model.embed_query(query)
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if return_embeddings else [])
+
+    def search_chapter(Chapter_DB):
+        with Metrics.span("per_chapter_search"):
+            return Chapter_DB._collection.query(query_embeddings=[list(query_embedding)], n_results=top_k_per_chapter, include=include)
+
+    Docs_Scores = []
+    for results in _Search_Executor.map(search_chapter, SelectedChapters):
+        Docs_Scores.extend(_results_to_docs_scores(results, return_embeddings))
+
+    Docs_Scores.sort(key=lambda doc_score: doc_score[1], reverse=True)
+    Metrics.incr("chunks_retrieved", len(Docs_Scores))
+    return Docs_Scores if top_k is None else Docs_Scores[:top_k]
+
+@traced("unified_search")
+def search_unified(query, Unified_DB, selected_chapters, top_k, Model, query_embedding=None, return_embeddings=False):
+    if query_embedding is None:
+        query_embedding = Model.embed_query(query)
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if return_embeddings else [])
+
+    where = None
+    if selected_chapters is not None:
+        where = {"chapter": {"$in": list(selected_chapters)}}
+    results = Unified_DB._collection.query(query_embeddings=[list(query_embedding)], n_results=top_k, where=where, include=include)
+    Docs_Scores = _results_to_docs_scores(results, return_embeddings)
+    Metrics.incr("chunks_retrieved", len(Docs_Scores))
+    return Docs_Scores
+
+def _results_to_docs_scores(results, return_embeddings=False):
+    Docs_Scores = []
+    embeddings = results.get("embeddings") if return_embeddings else None
+    for i, (text, metadata, distance) in enumerate(zip(results["documents"][0], results["metadatas"][0], results["distances"][0])):
+        score = 1.0 - distance
+        doc = Document(page_content=text, metadata={**(metadata or {}), "score": score})
+        if return_embeddings:
+            Docs_Scores.append((doc, score, np.asarray(embeddings[0][i], dtype=np.float32)))
+        else:
+            Docs_Scores.append((doc, score))
+    return Docs_Scores
+
+@traced("rerank")
+def rerank_chunks(Docs_Scores, top_k, query=None, cross_encoder=None, diversity=0.0):
+    Best_Chunks = {}
+    for doc_score in Docs_Scores:
+        key = (doc_score[0].metadata.get("chapter"), doc_score[0].metadata.get("chunk_index"), doc_score[0].page_content)
+        if key not in Best_Chunks or doc_score[1] > Best_Chunks[key][1]:
+            Best_Chunks[key] = doc_score
+    Candidates = list(Best_Chunks.values())
+
+    if cross_encoder is not None and Candidates:
+        cross_scores = cross_encoder.predict([(query, doc_score[0].page_content) for doc_score in Candidates])
+        Candidates = [(doc_score[0], float(cross_score), *doc_score[2:]) for doc_score, cross_score in zip(Candidates, cross_scores)]
+    Candidates.sort(key=lambda doc_score: doc_score[1], reverse=True)
+
+    if diversity <= 0 or not Candidates or len(Candidates[0]) < 3:
+        return [doc_score[0] for doc_score in Candidates[:top_k]]
+
+    # Maximal marginal relevance over the vectors returned by the first search.
+    embeddings = _normalize_rows(np.stack([doc_score[2] for doc_score in Candidates]))
+    relevance = np.asarray([doc_score[1] for doc_score in Candidates], dtype=np.float32)
+    selected = [0]
+    max_similarity = embeddings @ embeddings[0]
+    while len(selected) < min(top_k, len(Candidates)):
+        mmr = (1.0 - diversity) * relevance - diversity * max_similarity
+        mmr[selected] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, embeddings @ embeddings[best])
+    return [Candidates[i][0] for i in selected]
+
+
+#   Lexical index   #
+Section_Pattern = re.compile(r"\b(?:[A-Z]{1,2}\d{3,4}(?:\.\d+)*|Chapter_\d+_Table_\d+)\b", re.IGNORECASE)
+Word_Pattern = re.compile(r"[a-z0-9]+")
+
+def section_ids(text):
+    return [match.lower() for match in Section_Pattern.findall(text)]
+
+def lexical_tokens(text):
+    tokens = Word_Pattern.findall(text.lower())
+    for section_id in section_ids(text):
+        parts = section_id.split(".")
+        tokens.extend(".".join(parts[:i]) for i in range(1, len(parts) + 1))
+    return tokens
+
+def lexical_index_path(chunk_size, chunk_overlap, type):
+    return os.path.join(chunk_folder_path(chunk_size, chunk_overlap, type), "lexical_index.npz")
+
+def save_lexical_index(Store, chunk_size, chunk_overlap, type):
+    # Postings point at ChunkStore ids; the chunk text itself is only kept once, in the store.
+    Postings = {}
+    doc_lengths = []
+    for doc_id in range(len(Store)):
+        tokens = lexical_tokens(Store.get_text(doc_id))
+        doc_lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            Postings.setdefault(token, []).append((doc_id, count))
+
+    terms = sorted(Postings)
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(Postings[term]) for term in terms])
+    posting_docs = np.asarray([doc_id for term in terms for doc_id, count in Postings[term]], dtype=np.int32)
+    posting_counts = np.asarray([min(count, 65535) for term in terms for doc_id, count in Postings[term]], dtype=np.uint16)
+
+    path = lexical_index_path(chunk_size, chunk_overlap, type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(
+        path,
+        terms=np.asarray(terms, dtype=str),
+        term_offsets=term_offsets,
+        posting_docs=posting_docs,
+        posting_counts=posting_counts,
+        doc_lengths=np.asarray(doc_lengths, dtype=np.int32),
+        store_digest=np.asarray(Store.digest or "", dtype=str),
+    )
+    print(f"Lexical index built for {len(Store)} chunks and {len(terms)} terms in {path}")
+
+def build_lexical_index(chunk_size, chunk_overlap, type):
+    Store = open_chunk_store(chunk_size, chunk_overlap, type)
+    if Store is None:
+        print(f"Skipping lexical index: no chunks for size {chunk_size} and overlap {chunk_overlap}.")
+        return
+    save_lexical_index(Store, chunk_size, chunk_overlap, type)
+
+class LexicalIndex:
+    def __init__(self, chunk_size, chunk_overlap, type, k1=1.2, b=0.75):
+        self.Store = ChunkStore(chunk_size, chunk_overlap, type)
+        with np.load(lexical_index_path(chunk_size, chunk_overlap, type), allow_pickle=False) as data:
+            self.term_ids = {term: i for i, term in enumerate(data["terms"].tolist())}
+            self.term_offsets = data["term_offsets"]
+            self.posting_docs = data["posting_docs"]
+            self.posting_counts = data["posting_counts"].astype(np.float32)
+            self.doc_lengths = data["doc_lengths"].astype(np.float32)
+            store_digest = str(data["store_digest"])
+        # Any edit to the chunk text changes the store digest, even one that keeps every length the same.
+        if not store_digest or store_digest != self.Store.digest or len(self.doc_lengths) != len(self.Store):
+            raise ValueError("Lexical index does not match the chunk store, rebuild it with build_lexical_index.")
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def get(self, doc_id):
+        return self.Store.get(doc_id)
+
+    def _postings(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return None, None
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.posting_docs[start:end], self.posting_counts[start:end]
+
+    def scores(self, query):
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(lexical_tokens(query)):
+            doc_ids, counts = self._postings(term)
+            if doc_ids is None:
+                continue
+            idf = np.log(1.0 + (len(self) - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[doc_ids] / self.average_length)
+            scores[doc_ids] += idf * counts * (self.k1 + 1.0) / (counts + norm)
+        return scores
+
+    def _ranked(self, scores, candidates, top_k):
+        candidates = candidates[scores[candidates] > 0]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        Docs_Scores = []
+        for doc_id in candidates:
+            doc = self.get(doc_id)
+            doc.metadata["score"] = float(scores[doc_id])
+            Docs_Scores.append((doc, float(scores[doc_id])))
+        return Docs_Scores
+
+    def search(self, query, top_k, selected_chapters=None):
+        scores = self.scores(query)
+        candidates = np.arange(len(self))
+        if selected_chapters is not None:
+            candidates = candidates[np.isin(self.Store.chapters, list(selected_chapters))]
+        Metrics.incr("lexical_searches")
+        return self._ranked(scores, candidates, top_k)
+
+    def section_lookup(self, query, top_k):
+        matches = [self._postings(section_id)[0] for section_id in section_ids(query)]
+        matches = [doc_ids for doc_ids in matches if doc_ids is not None]
+        if not matches:
+            return []
+        Metrics.incr("section_lookups")
+        return self._ranked(self.scores(query), np.unique(np.concatenate(matches)), top_k)
+
+_Lexical_Indexes = {}
+
+def get_lexical_index(chunk_size, chunk_overlap, type):
+    path = lexical_index_path(chunk_size, chunk_overlap, type)
+    with _Pool_Lock:
+        if not os.path.exists(path) or not chunk_store_exists(chunk_size, chunk_overlap, type):
+            return None
+        folder_path = chunk_folder_path(chunk_size, chunk_overlap, type)
+        mtime = (os.stat(path).st_mtime_ns, max(os.stat(os.path.join(folder_path, file)).st_mtime_ns for file in Chunk_Store_Files))
+        if path not in _Lexical_Indexes or _Lexical_Indexes[path][0] != mtime:
+            print(f"Loading lexical index from: {path}")
+            try:
+                _Lexical_Indexes[path] = (mtime, LexicalIndex(chunk_size, chunk_overlap, type))
+            except (KeyError, ValueError) as e:
+                print(f"Skipping lexical index {path}: {e}")
+                _Lexical_Indexes[path] = (mtime, None)
+        return _Lexical_Indexes[path][1]
+
+def reciprocal_rank_fusion(Result_Lists, k=60, top_k=None):
+    Fused = {}
+    for Docs_Scores in Result_Lists:
+        for rank, doc_score in enumerate(Docs_Scores, start=1):
+            doc = doc_score[0]
+            key = (doc.metadata.get("chapter"), doc.metadata.get("chunk_index"), doc.page_content)
+            if key not in Fused:
+                Fused[key] = [doc, 0.0]
+            Fused[key][1] += 1.0 / (k + rank)
+
+    Docs_Scores = sorted(((doc, score) for doc, score in Fused.values()), key=lambda doc_score: doc_score[1], reverse=True)
+    for doc, score in Docs_Scores:
+        doc.metadata["score"] = score
+    return Docs_Scores if top_k is None else Docs_Scores[:top_k]
+
+
+#   Chapter router   #
+def _intros_hash(model_name, Intros):
+    hasher = hashlib.sha256(model_name.encode("utf-8"))
+    for doc in Intros:
+        hasher.update(str(doc.metadata.get("chapter")).encode("utf-8"))
+        hasher.update(doc.page_content.encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def build_chapter_router(Model, model_name, Intros=None, cache_folder="Pkl_Files/Chapter_Router", backend=None):
+    if Intros is None:
+        Intros = Chapters_Intros
+    backend = backend or Embedding_Config["backend"]
+    cache_name = model_name if backend == "torch" else f"{model_name}@{backend}"
+
+    os.makedirs(cache_folder, exist_ok=True)
+    cache_file = os.path.join(cache_folder, f"{cache_name.replace('/', '-')}_{_intros_hash(cache_name, Intros)}.npy")
+
+    if os.path.exists(cache_file):
+        print(f"Loading chapter router embeddings from: {cache_file}")
+        embeddings = np.load(cache_file)
+    else:
+        print(f"Embedding {len(Intros)} chapter intros for the router.")
+        embeddings = np.asarray(Model.embed_documents([doc.page_content for doc in Intros]), dtype=np.float32)
+        np.save(cache_file, embeddings)
+
+    return {"embeddings": _normalize_rows(embeddings.astype(np.float32)), "docs": list(Intros)}
+
+@traced("routing")
+def route_chapters(Router, Model, query, top_k=5, query_embedding=None):
+    if query_embedding is None:
+        query_embedding = Model.embed_query(query)
+    query_embedding = _normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+    scores = Router["embeddings"] @ query_embedding
+    top_k = min(top_k, len(scores))
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+    Metrics.incr("chapters_routed", len(best))
+    return [Router["docs"][i] for i in best]
+
+
+#   Table row index   #
+def _clean_cell(cell):
+    return re.sub(r"\s+", " ", str(cell)).strip() if cell is not None else ""
+
+def _row_text(row):
+    return " | ".join(cell for cell in (_clean_cell(cell) for cell in row) if cell)
+
+def table_rows(chapter_number, tables_list):
+    Headers = []
+    Rows = []
+    for i, table in enumerate(tables_list, start=1):
+        if not table:
+            continue
+        header_rows = table[:2] if None in table[0] and len(table) > 2 else table[:1]
+        header = " / ".join(text for text in (_row_text(row) for row in header_rows) if text)
+        Headers.append((f"Chapter_{chapter_number}_Table_{i}", header))
+        for row_index, row in enumerate(table[len(header_rows):], start=1):
+            text = _row_text(row)
+            if text:
+                Rows.append({"chapter": chapter_number, "table": len(Headers) - 1, "row": row_index, "text": text})
+    return Headers, Rows
+
+def table_row_index_path(model_name, output_folder="Pkl_Files/Table_Rows"):
+    return os.path.join(output_folder, f"{model_name.replace('/', '-')}.npz")
+
+def table_row_manifest_path(output_folder="Pkl_Files/Table_Rows"):
+    return os.path.join(output_folder, "manifest.json")
+
+def list_chapter_files(input_folder="Pkl_Files/Chapters"):
+    if not os.path.exists(input_folder):
+        return []
+    chapters = {extract_chapter_number(os.path.splitext(file)[0]) for file in os.listdir(input_folder) if file.endswith((".json", ".pkl"))}
+    return sorted(chapter for chapter in chapters if chapter != -1)
+
+def save_table_row_index(chapters, Model, model_name):
+    if chapters is None:
+        chapters = list_chapter_files()
+    Headers = []
+    Rows = []
+    for chapter in chapters:
+        chapter_data = load_chapter_from_pkl(chapter)
+        if chapter_data is None:
+            continue
+        chapter_headers, chapter_rows = table_rows(chapter, chapter_data["tables"])
+        for row in chapter_rows:
+            row["table"] += len(Headers)
+        Headers.extend(chapter_headers)
+        Rows.extend(chapter_rows)
+
+    row_documents = [f"{Headers[row['table']][0]}: {Headers[row['table']][1]} || {row['text']}" for row in Rows]
+    rows_hash = content_hash(model_name + "".join(row_documents))
+    manifest = load_manifest(table_row_manifest_path())
+    if manifest.get(model_name) == rows_hash and os.path.exists(table_row_index_path(model_name)):
+        print(f"Table row index unchanged: {table_row_index_path(model_name)}")
+        return
+    embeddings = _normalize_rows(np.asarray(Model.embed_documents(row_documents), dtype=np.float32)) if Rows else np.zeros((0, 0), dtype=np.float32)
+    row_blob, row_offsets = _pack_texts([row["text"] for row in Rows])
+    label_blob, label_offsets = _pack_texts([label for label, header in Headers])
+    header_blob, header_offsets = _pack_texts([header for label, header in Headers])
+
+    path = table_row_index_path(model_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(
+        path,
+        embeddings=embeddings.astype(np.float16),
+        chapters=np.asarray([row["chapter"] for row in Rows], dtype=np.int32),
+        tables=np.asarray([row["table"] for row in Rows], dtype=np.int32),
+        rows=np.asarray([row["row"] for row in Rows], dtype=np.int32),
+        row_blob=row_blob, row_offsets=row_offsets,
+        label_blob=label_blob, label_offsets=label_offsets,
+        header_blob=header_blob, header_offsets=header_offsets,
+    )
+    manifest[model_name] = rows_hash
+    save_manifest(manifest, table_row_manifest_path())
+    print(f"Table row index built for {len(Rows)} rows from {len(Headers)} tables in {path}")
+
+class TableRowIndex:
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            self.embeddings = data["embeddings"].astype(np.float32)
+            self.chapters = data["chapters"]
+            self.tables = data["tables"]
+            self.rows = data["rows"]
+            self._row_blob, self._row_offsets = data["row_blob"], data["row_offsets"]
+            self.labels = [_unpack_text(data["label_blob"], data["label_offsets"], i) for i in range(len(data["label_offsets"]) - 1)]
+            self.headers = [_unpack_text(data["header_blob"], data["header_offsets"], i) for i in range(len(data["header_offsets"]) - 1)]
+        self.label_ids = {label.lower(): i for i, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, row_id, score=None):
+        table = int(self.tables[row_id])
+        return Document(
+            page_content=_unpack_text(self._row_blob, self._row_offsets, row_id),
+            metadata={"chapter": int(self.chapters[row_id]), "table": self.labels[table], "header": self.headers[table], "row": int(self.rows[row_id]), "score": score}
+        )
+
+    @traced("table_search")
+    def search(self, query, query_embedding, top_k=8, selected_chapters=None, min_score=0.35):
+        candidates = np.arange(len(self))
+        labelled = [self.label_ids[section_id] for section_id in section_ids(query) if section_id in self.label_ids]
+        if labelled:
+            candidates = candidates[np.isin(self.tables, labelled)]
+        elif selected_chapters is not None:
+            candidates = candidates[np.isin(self.chapters, list(selected_chapters))]
+        if len(candidates) == 0:
+            return []
+
+        scores = self.embeddings[candidates] @ _normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        keep = np.arange(len(candidates)) if labelled else np.flatnonzero(scores >= min_score)
+        keep = keep[np.argsort(-scores[keep])][:top_k]
+        Metrics.incr("table_rows_retrieved", len(keep))
+        return [(self.get(candidates[i], float(scores[i])), float(scores[i])) for i in keep]
+
+def format_table_rows(Docs_Scores):
+    Tables = OrderedDict()
+    for doc, score in Docs_Scores:
+        if doc.metadata["table"] not in Tables:
+            Tables[doc.metadata["table"]] = [doc.metadata["header"]]
+        Tables[doc.metadata["table"]].append(doc.page_content)
+    return "\n".join(f"{label}: " + "\n".join(lines) for label, lines in Tables.items())
+
+_Table_Row_Indexes = {}
+
+def get_table_row_index(model_name):
+    path = table_row_index_path(model_name)
+    with _Pool_Lock:
+        if not os.path.exists(path):
+            return None
+        mtime = os.stat(path).st_mtime_ns
+        if path not in _Table_Row_Indexes or _Table_Row_Indexes[path][0] != mtime:
+            print(f"Loading table row index from: {path}")
+            _Table_Row_Indexes[path] = (mtime, TableRowIndex(path))
+        return _Table_Row_Indexes[path][1]
+
+def submit_table_search(Table_Index, query, query_embedding, top_k=8, selected_chapters=None):
+    return _Search_Executor.submit(Table_Index.search, query, query_embedding, top_k, selected_chapters)
+
+
+#   Context assembly   #
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+def merge_overlapping_text(previous_text, next_text, max_overlap=None, min_overlap=16):
+    longest = min(len(previous_text), len(next_text), max_overlap or len(next_text))
+    for overlap in range(longest, min_overlap - 1, -1):
+        if previous_text.endswith(next_text[:overlap]):
+            return previous_text + next_text[overlap:]
+    return previous_text + " " + next_text
+
+def truncate_to_tokens(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    truncated = text[:max_tokens * 4]
+    sentence_end = truncated.rfind(". ")
+    if sentence_end > len(truncated) // 2:
+        return truncated[:sentence_end + 1]
+    return truncated.rsplit(" ", 1)[0]
+
+def assemble_context(Docs, token_budget, chunk_overlap=None, min_fill_tokens=64):
+    Groups = []
+    ordered = sorted(enumerate(Docs), key=lambda rank_doc: (str(rank_doc[1].metadata.get("chapter")), rank_doc[1].metadata.get("chunk_index") or 0))
+    for rank, doc in ordered:
+        score = doc.metadata.get("score", -rank)
+        previous = Groups[-1] if Groups else None
+        if (previous is not None and doc.metadata.get("chunk_index") is not None
+                and previous["chapter"] == doc.metadata.get("chapter")
+                and doc.metadata["chunk_index"] - previous["last_index"] <= 1):
+            if doc.metadata["chunk_index"] != previous["last_index"]:
+                previous["text"] = merge_overlapping_text(previous["text"], doc.page_content, chunk_overlap)
+            previous["last_index"] = doc.metadata["chunk_index"]
+            previous["score"] = max(previous["score"], score)
+            continue
+        Groups.append({"chapter": doc.metadata.get("chapter"), "last_index": doc.metadata.get("chunk_index"), "text": doc.page_content, "score": score})
+
+    Groups.sort(key=lambda group: group["score"], reverse=True)
+    Context = []
+    tokens_used = 0
+    for group in Groups:
+        remaining = token_budget - tokens_used
+        group_tokens = estimate_tokens(group["text"])
+        if group_tokens <= remaining:
+            Context.append(group["text"])
+            tokens_used += group_tokens
+        elif remaining >= min_fill_tokens:
+            Context.append(truncate_to_tokens(group["text"], remaining))
+            tokens_used += estimate_tokens(Context[-1])
+            break
+        # Too big to fit or to be worth truncating: a smaller, lower-scored group may still fit.
+
+    tokens_raw = sum(estimate_tokens(doc.page_content) for doc in Docs)
+    stats = {
+        "chunks": len(Docs),
+        "groups": len(Groups),
+        "tokens_raw": tokens_raw,
+        "tokens_merged": sum(estimate_tokens(group["text"]) for group in Groups),
+        "tokens_used": tokens_used,
+        "tokens_saved": tokens_raw - tokens_used,
+    }
+    Metrics.observe("context_tokens", tokens_used)
+    Metrics.observe("context_tokens_raw", tokens_raw)
+    Metrics.incr("context_tokens_saved", stats["tokens_saved"])
+    if Metrics_Logger.isEnabledFor(logging.DEBUG):
+        Metrics_Logger.debug(json.dumps({"context": stats}))
+    return " ".join(Context), stats
 
 
 #Invoking LLama model using Ollama
 
-def generate_llama_response(RetrievedText_Text,RetrievedText_Table, query):
+Ollama_Url = 'http://localhost:11434/api/generate'
+Ollama_Timeout = (5, 120)
+
+_Ollama_Session = requests.Session()
+_Ollama_Session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_Ollama_Session.headers.update({'Content-Type': 'application/json'})
+
+def build_llama_prompt(RetrievedText_Text,RetrievedText_Table, query):
+    return f"I will provide you content. Please use that content only to answer my query. Text: {RetrievedText_Text}, Table:{RetrievedText_Table} Query: {query}"
+
+def stream_llama_response(RetrievedText_Text,RetrievedText_Table, query, timeout=None, cancel_event=None, stream_state=None):
+    # stream_state reports the outcome out-of-band: "done" is only set once Ollama sends done: true,
+    # "error" holds the failure; the yielded text is never inspected to decide either.
+    if stream_state is None:
+        stream_state = {}
+    stream_state["done"] = False
+    stream_state["error"] = None
     if not RetrievedText_Text.strip():
-        return " No retrieved text available for answering."
+        stream_state["error"] = "no retrieved text"
+        yield " No retrieved text available for answering."
+        return
 
     payload = {
         "model": "llama3",
-        "prompt": f"I will provide you content. Please use that content only to answer my query. Text: {RetrievedText_Text}, Table:{RetrievedText_Table} Query: {query}",
+        "prompt": build_llama_prompt(RetrievedText_Text,RetrievedText_Table, query),
+        "stream": True,
     }
-    
+    Metrics.incr("llm_requests")
+    Metrics.observe("prompt_chars", len(payload["prompt"]))
+    started = time.perf_counter()
+    first_token = True
+
     try:
-        url = 'http://localhost:11434/api/generate'
-        response = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        with _Ollama_Session.post(Ollama_Url, data=json.dumps(payload), stream=True, timeout=timeout or Ollama_Timeout) as response:
+            stream_state["response"] = response
+            if response.status_code != 200:
+                Metrics.incr("llm_errors")
+                stream_state["error"] = f"status {response.status_code}"
+                yield f" API Error: {response.status_code} - {response.text}"
+                return
 
-        if response.status_code == 200:
-            list_dict_words = []
-            for each_word in response.text.split("\n"):
+            for line in response.iter_lines(decode_unicode=True):
+                if cancel_event is not None and cancel_event.is_set():
+                    stream_state["error"] = "cancelled"
+                    return
+                if not line:
+                    continue
                 try:
-                    data = json.loads(each_word)
-                except:
-                    pass
-                list_dict_words.append(data)
-            
-            llama_response = " ".join([word['response'] for word in list_dict_words if isinstance(word, dict)])
-            return llama_response if llama_response else " No meaningful response from LLama3."
+                    data = json.loads(line)
+                except ValueError:
+                    continue
 
-        return f" API Error: {response.status_code} - {response.text}"
+                if "error" in data:
+                    Metrics.incr("llm_errors")
+                    stream_state["error"] = data["error"]
+                    yield f" API Error: {data['error']}"
+                    return
+                if data.get("response"):
+                    if first_token:
+                        Metrics.observe("stage_seconds:time_to_first_token", time.perf_counter() - started)
+                        first_token = False
+                    yield data["response"]
+                if data.get("done"):
+                    for field in ("prompt_eval_count", "eval_count"):
+                        if field in data:
+                            Metrics.observe(f"ollama_{field}", data[field])
+                    for field in ("prompt_eval_duration", "eval_duration", "load_duration", "total_duration"):
+                        if field in data:
+                            Metrics.observe(f"ollama_{field}_seconds", data[field] / 1e9)
+                    stream_state["done"] = True
+                    return
+
+            stream_state["error"] = "stream ended without done"
 
     except Exception as e:
-        return f" Failed to connect to Llama API: {str(e)}"
+        Metrics.incr("llm_errors")
+        stream_state["error"] = str(e)
+        yield f" Failed to connect to Llama API: {str(e)}"
+    finally:
+        stream_state.pop("response", None)
+        Metrics.observe("stage_seconds:generation", time.perf_counter() - started)
+
+def close_llama_stream(stream_state):
+    # Called from another thread: shutting the socket down unblocks a pending read right away
+    # instead of after the read timeout, and closing the response drops the connection from the pool.
+    response = stream_state.get("response")
+    if response is None:
+        return
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+def is_complete_stream(stream_state, answer):
+    return bool(stream_state.get("done")) and stream_state.get("error") is None and bool(answer.strip())
+
+def generate_llama_response(RetrievedText_Text,RetrievedText_Table, query, timeout=None, cancel_event=None, stream_state=None):
+    llama_response = "".join(stream_llama_response(RetrievedText_Text,RetrievedText_Table, query, timeout, cancel_event, stream_state))
+    return llama_response if llama_response else " No meaningful response from LLama3."
     
     
 #as_retriver from ChromaDB
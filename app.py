@@ -1,77 +1,182 @@
 import gradio as gr
-import requests
-import json
-from langchain.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from Helper import ( load_chroma_databases, retrieve_relevant_chunks,retrieve_relevant_chunks_Pass_Chapters_To_BestChunks,Chapters_Intros)
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from Helper import ( load_chroma_databases,build_chapter_router,route_chapters,get_embedding_model,warm_chroma_pool,search_chapters,rerank_chunks,search_unified,get_chroma_store,Unified_Index_Name,generate_llama_response,stream_llama_response,close_llama_stream,AnswerCache,index_version,is_complete_stream,Metrics,start_metrics_server,get_lexical_index,reciprocal_rank_fusion,assemble_context,get_table_row_index,submit_table_search,format_table_rows,configure_embedding_backend)
 
 #  CONFIGURATION  #
 
 
 model_name = "sentence-transformers/all-MiniLM-L6-v2"
-Model = HuggingFaceEmbeddings(model_name=model_name)
+Use_Unified_Index = False
+Use_Hybrid_Retrieval = True
+Use_Table_Rows = True
+Table_Rows_Top_K = 8
+Table_Latency_Budget = 0.05
+configure_embedding_backend(backend="torch", batch_size=32, threads=None, micro_batch=True)
+Model = get_embedding_model(model_name)
+Router = build_chapter_router(Model, model_name)
+Answer_Cache = AnswerCache(threshold=0.95, ttl=3600, max_items=1000)
+Metrics_Port = 9464
+Metrics_Host = "127.0.0.1"  # set to "0.0.0.0" to let a remote scraper reach /metrics
+Metrics.register_source("embedding_cache", Model.stats)
+Metrics.register_source("answer_cache", Answer_Cache.stats)
+
+#  SERVING CONFIGURATION  #
+Retrieval_Workers = 4
+Ollama_Concurrency = 2
+Handler_Concurrency = 16
+Queue_Max_Size = 64
+Retrieval_Timeout = 30
+Generation_Timeout = 300
+
+Retrieval_Executor = ThreadPoolExecutor(max_workers=Retrieval_Workers, thread_name_prefix="retrieval")
+Generation_Executor = ThreadPoolExecutor(max_workers=Ollama_Concurrency, thread_name_prefix="generation")
+Ollama_Semaphore = asyncio.Semaphore(Ollama_Concurrency)
 
 #  GRADIO FUNCTIONS  #
 def get_chunk_params(answer_length):
     params = {"Very Short": (800, 150, 2),"Short": (800, 150, 3),"Long": (800, 150, 4),"Very Long": (800, 150, 5)}    
     return params.get(answer_length, (1000, 100,6))
 
-
-def retrieve_text(query,length_input):
-    selected_chapters_UnProcessed=retrieve_relevant_chunks_Pass_Chapters_To_BestChunks('./ChromaDB_Query/Intro_SelectChapters',Chapters_Intros,Model,query,5)
+def get_context_budget(answer_length):
+    budgets = {"Very Short": 600,"Short": 900,"Long": 1400,"Very Long": 2000}
+    return budgets.get(answer_length, 2400)
+
+
+def lookup_answer(query,length_input):
+    Metrics.incr("questions")
+    with Metrics.span("answer_cache_lookup"):
+        chunk_size, chunk_overlap, _ = get_chunk_params(length_input)
+        query_embedding = Model.embed_query(query)
+        version = index_version(model_name,"text",chunk_size,chunk_overlap)
+        Cached_Answer = Answer_Cache.get(query, query_embedding, length_input, version)
+    if Cached_Answer is not None:
+        Metrics.incr("answer_cache_hits")
+    return Cached_Answer, query_embedding, version
+
+def store_answer(query,length_input,query_embedding,version,LLm_Generated_Answer,stream_state):
+    if is_complete_stream(stream_state, LLm_Generated_Answer):
+        Answer_Cache.put(query, query_embedding, length_input, version, LLm_Generated_Answer)
+
+def retrieve_docs(query,chunk_size,chunk_overlap,top_k_per_chapter,top_k=10,query_embedding=None,hybrid=None):
+    if hybrid is None:
+        hybrid = Use_Hybrid_Retrieval
+    Lexical_Index = get_lexical_index(chunk_size,chunk_overlap,"text") if hybrid else None
+    if Lexical_Index is not None:
+        Docs_Scores_Section = Lexical_Index.section_lookup(query, top_k)
+        if Docs_Scores_Section:
+            return [doc for doc, score in Docs_Scores_Section]
+
+    if query_embedding is None:
+        query_embedding = Model.embed_query(query)
+    selected_chapters_UnProcessed=route_chapters(Router,Model,query,5,query_embedding=query_embedding)
     selected_chapters = [doc.metadata['chapter'] for doc in selected_chapters_UnProcessed]
 
+    Unified_text = get_chroma_store(model_name,"text",chunk_size,chunk_overlap,Unified_Index_Name) if Use_Unified_Index else None
+    if Unified_text is not None:
+        Docs_Scores_Text = search_unified(query, Unified_text, selected_chapters, top_k_per_chapter * len(selected_chapters), Model, query_embedding=query_embedding)
+    else:
+        # No unified index on disk for this chunk config: fall back to the per-chapter stores.
+        SelectedChapters_text = load_chroma_databases(model_name,"text",chunk_size,chunk_overlap,selected_chapters=selected_chapters)
+        Docs_Scores_Text = search_chapters(query, SelectedChapters_text, top_k_per_chapter, Model, query_embedding=query_embedding)
+    if Lexical_Index is not None:
+        Docs_Scores_Text = reciprocal_rank_fusion([Docs_Scores_Text, Lexical_Index.search(query, len(Docs_Scores_Text) or top_k)])
+    return rerank_chunks(Docs_Scores_Text, top_k, query=query)
+
+def retrieve_context(query,length_input,query_embedding=None):
     chunk_size, chunk_overlap, top_k_per_chapter =get_chunk_params(length_input)
     top_k = 10#((top_k_per_chapter) * len(selected_chapters)) // 2
-    
-    SelectedChapters_text = load_chroma_databases(model_name,"text",chunk_size,chunk_overlap,selected_chapters=selected_chapters)
-    Docs_Score_Text = retrieve_relevant_chunks(query, SelectedChapters_text, top_k_per_chapter)
-    if(len(Docs_Score_Text)>10):
-        Docs_Score_Text=retrieve_relevant_chunks_Pass_Chapters_To_BestChunks('ChromaDB_Query/Text',Docs_Score_Text,Model,query,top_k)    
-    Retrieved_Text = " ".join([doc.page_content for doc in Docs_Score_Text])
-
-
-    #SelectedChapters_Table= load_chroma_databases(model_name,"table",chunk_size,chunk_overlap,selected_chapters=selected_chapters)
-    #Docs_Score_Table = retrieve_relevant_chunks(query, SelectedChapters_Table, top_k_per_chapter)
-    #if(len(Docs_Score_Table)>10):
-    #    Docs_Score_Table = retrieve_relevant_chunks_Pass_Chapters_To_BestChunks('./ChromaDB_Query/Table',Docs_Score_Table,Model,query,top_k)
-    #Retrieved_Table = " ".join([doc.page_content for doc in Docs_Score_Table])
+
+    Table_Index = get_table_row_index(model_name) if Use_Table_Rows else None
+    Table_Search = None
+    if Table_Index is not None:
+        if query_embedding is None:
+            query_embedding = Model.embed_query(query)
+        Table_Search = submit_table_search(Table_Index, query, query_embedding, Table_Rows_Top_K)
+
+    with Metrics.span("retrieval"):
+        Docs_Score_Text = retrieve_docs(query,chunk_size,chunk_overlap,top_k_per_chapter,top_k,query_embedding)
+    Retrieved_Text, Context_Stats = assemble_context(Docs_Score_Text, get_context_budget(length_input), chunk_overlap)
+
     Retrieved_Table="NO TABLE"
+    if Table_Search is not None:
+        try:
+            Docs_Score_Table = Table_Search.result(timeout=Table_Latency_Budget)
+            if Docs_Score_Table:
+                Retrieved_Table = format_table_rows(Docs_Score_Table)
+        except FutureTimeoutError:
+            Table_Search.cancel()
+            Metrics.incr("table_search_timeouts")
 
-    LLm_Generated_Answer=generate_llama_response(Retrieved_Text,Retrieved_Table, query)
+    return Retrieved_Text, Retrieved_Table, Context_Stats
 
-    return LLm_Generated_Answer
+def retrieve_text(query,length_input):
+    Cached_Answer, query_embedding, version = lookup_answer(query,length_input)
+    if Cached_Answer is not None:
+        return Cached_Answer
+
+    Retrieved_Text, Retrieved_Table, Context_Stats = retrieve_context(query,length_input,query_embedding)
 
-def generate_llama_response(RetrievedText_Text,RetrievedText_Table, query):
-    if not RetrievedText_Text.strip():
-        return " No retrieved text available for answering."
+    stream_state = {}
+    LLm_Generated_Answer=generate_llama_response(Retrieved_Text,Retrieved_Table, query, stream_state=stream_state)
 
-    payload = {
-        "model": "llama3",
-        "prompt": f"I will provide you content. Please use that content only to answer my query. Text: {RetrievedText_Text}, Table:{RetrievedText_Table} Query: {query}",
-    }
-    
+    store_answer(query,length_input,query_embedding,version,LLm_Generated_Answer,stream_state)
+    return LLm_Generated_Answer
+
+async def retrieve_text_async(query,length_input):
+    loop = asyncio.get_running_loop()
     try:
-        url = 'http://localhost:11434/api/generate'
-        response = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
-
-        if response.status_code == 200:
-            list_dict_words = []
-            for each_word in response.text.split("\n"):
-                try:
-                    data = json.loads(each_word)
-                except:
-                    pass
-                list_dict_words.append(data)
-            
-            llama_response = " ".join([word['response'] for word in list_dict_words if isinstance(word, dict)])
-            return llama_response if llama_response else " No meaningful response from LLama3."
-
-        return f" API Error: {response.status_code} - {response.text}"
-
-    except Exception as e:
-        return f" Failed to connect to Llama API: {str(e)}"
-    
+        Cached_Answer, query_embedding, version = await asyncio.wait_for(
+            loop.run_in_executor(Retrieval_Executor, lookup_answer, query, length_input), Retrieval_Timeout)
+        if Cached_Answer is not None:
+            yield Cached_Answer
+            return
+
+        Retrieved_Text, Retrieved_Table, Context_Stats = await asyncio.wait_for(
+            loop.run_in_executor(Retrieval_Executor, retrieve_context, query, length_input, query_embedding), Retrieval_Timeout)
+    except asyncio.TimeoutError:
+        yield " Retrieval timed out, please try again."
+        return
+
+    async with Ollama_Semaphore:
+        cancel_event = threading.Event()
+        stream_state = {}
+        tokens = stream_llama_response(Retrieved_Text,Retrieved_Table, query, cancel_event=cancel_event, stream_state=stream_state)
+        deadline = loop.time() + Generation_Timeout
+        LLm_Generated_Answer = ""
+        pending = None
+        try:
+            while True:
+                pending = loop.run_in_executor(Generation_Executor, next, tokens, None)
+                done, _ = await asyncio.wait({pending}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    raise asyncio.TimeoutError
+                token = pending.result()
+                if token is None:
+                    break
+                LLm_Generated_Answer += token
+                yield LLm_Generated_Answer
+        except asyncio.TimeoutError:
+            stream_state["error"] = "generation timed out"
+            LLm_Generated_Answer += " [Generation timed out]"
+            yield LLm_Generated_Answer
+        finally:
+            # Closing the response unblocks the generation thread still reading from Ollama,
+            # so the semaphore slot and executor thread are only released once it is free again.
+            cancel_event.set()
+            close_llama_stream(stream_state)
+            if pending is not None and not pending.done():
+                await asyncio.wait({pending}, timeout=5)
+
+    if not LLm_Generated_Answer:
+        yield " No meaningful response from LLama3."
+    store_answer(query,length_input,query_embedding,version,LLm_Generated_Answer,stream_state)
+
+#  WARM VECTOR STORE POOL  #
+for chunk_size, chunk_overlap in sorted({get_chunk_params(length)[:2] for length in ["Very Short", "Short", "Long", "Very Long"]}):
+    warm_chroma_pool(model_name,"text",chunk_size,chunk_overlap,[Unified_Index_Name] if Use_Unified_Index else None)
+
 #  GRADIO INTERFACE  #
 with gr.Blocks() as demo:
     with gr.Tab("Ask a Question"):
@@ -84,13 +189,17 @@ with gr.Blocks() as demo:
         
         retrieved_output = gr.Textbox(label="Retrieved Chunks", interactive=False)
         retrieve_button.click(
-            retrieve_text, 
+            retrieve_text_async, 
             inputs=[query_input,length_input], 
-            outputs=[retrieved_output]  
+            outputs=[retrieved_output],
+            concurrency_limit=Handler_Concurrency
         )
 
 
 #  RUN GRADIO  #
-demo.launch()
+if __name__ == "__main__":
+    start_metrics_server(Metrics_Port, Metrics_Host)
+    demo.queue(max_size=Queue_Max_Size)
+    demo.launch()
 
 